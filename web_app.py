@@ -6,20 +6,62 @@ Uses Word template with seals and signatures for professional output
 API key loaded from .env file, model selection is automatic with fallback
 """
 
-from flask import Flask, render_template, request, send_file, jsonify
+from flask import Flask, Request, Response, g, render_template, request, send_file, jsonify
+import io
 import os
+import gzip
+import re
+import hashlib
+import shutil
 import tempfile
+import traceback
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from functools import lru_cache
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from word_generator import WordCertificateGenerator, GeminiExtractor as WordGeminiExtractor
+from flask.json.provider import DefaultJSONProvider
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from word_generator import WordCertificateGenerator, GeminiExtractor as WordGeminiExtractor, TokenBucket
 from word_generator import BuyerInfo, SellerInfo, ProductInfo, ShippingInfo, InvoiceInfo, CertificateData
 import json
 
 # Load environment variables from .env file
 load_dotenv()
 
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonify through orjson, which encodes straight to UTF-8 bytes"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
+
+
+class DiskSpooledRequest(Request):
+    """Uploads go straight to a temp file instead of being buffered in memory first"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.TemporaryFile('wb+')
+
+
 app = Flask(__name__)
+app.request_class = DiskSpooledRequest
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
 
@@ -29,6 +71,28 @@ TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'template.docx')
 # API key from environment (optional in form if set in .env)
 API_KEY = os.environ.get('GEMINI_API_KEY', '')
 
+# One generator for all requests - it holds no per-certificate state
+certificate_generator = WordCertificateGenerator(TEMPLATE_PATH)
+
+
+# Gemini quota per API key, e.g. 15 / 250000 on the free tier; uploads beyond it wait instead of failing.
+# Unset (the default) disables client-side limiting, so paid keys are not throttled to free-tier rates
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get('GEMINI_REQUESTS_PER_MINUTE') or 0)
+GEMINI_TOKENS_PER_MINUTE = int(os.environ.get('GEMINI_TOKENS_PER_MINUTE') or 250000)
+
+
+@lru_cache(maxsize=8)
+def get_extractor(api_key):
+    """
+    Shared extractor per API key, so the Gemini client and its connections are reused
+    and all requests using the key draw from one rate limiter (when one is configured)
+    """
+    rate_limiter = None
+    if GEMINI_REQUESTS_PER_MINUTE > 0:
+        rate_limiter = TokenBucket(GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE)
+    return WordGeminiExtractor(api_key, rate_limiter=rate_limiter)
+
+
 def get_api_key(form_key=None):
     """Get API key from form or environment"""
     if form_key and form_key.strip():
@@ -38,9 +102,110 @@ def get_api_key(form_key=None):
     return None
 
 
+def request_work_dir():
+    """
+    Private temp directory for the current request's uploads and outputs, so
+    concurrent requests never share a file name; removed when the request ends
+    """
+    if 'work_dir' not in g:
+        g.work_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    return g.work_dir
+
+
+@app.teardown_request
+def remove_work_dir(exc):
+    work_dir = g.pop('work_dir', None)
+    if work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def debug_dump(label, data):
+    """Pretty-print extracted data in debug mode only (indented dumps are slow per request)"""
+    if not app.debug:
+        return
+    if orjson is not None:
+        print(f"{label}:", orjson.dumps(data, option=orjson.OPT_INDENT_2).decode('utf-8'))
+    else:
+        print(f"{label}:", json.dumps(data, indent=2))
+
+
+def is_pdf(file):
+    """
+    Check the upload's magic bytes, so non-PDFs are rejected before any disk or Gemini work
+    Readers accept the %PDF- header anywhere in the first 1024 bytes, so this does too
+    """
+    head = file.stream.read(1024)
+    file.stream.seek(0)
+    return b'%PDF-' in head
+
+
+# Rendered index page - it has no per-request content, so it is rendered and
+# compressed once, per Content-Encoding (re-rendered every time in debug mode
+# so template edits show up). Built in locals and published as one (bodies, etag)
+# tuple, so concurrent requests never see a half-filled cache
+_index_cache = None
+
+_HTML_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_LINE_INDENT = re.compile(r'^\s+', re.MULTILINE)
+
+
+def minify_html(html):
+    """
+    Drop comments, indentation and blank lines from the rendered page
+    Line breaks are kept, so attributes split over lines stay separated
+    (index.html has no <pre> or pre-filled <textarea> content to protect)
+    """
+    return _LINE_INDENT.sub('', _HTML_COMMENT.sub('', html))
+
+
+def zip_response(docx_path, pdf_path):
+    """Bundle the generated Word and PDF files into an in-memory ZIP download and remove them"""
+    buffer = io.BytesIO()
+    # Stored, not deflated: .docx is already a deflated ZIP and the PDF's streams are compressed
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zipf:
+        for path, name in ((docx_path, 'certificate_of_origin.docx'), (pdf_path, 'certificate_of_origin.pdf')):
+            if path and os.path.exists(path):
+                zipf.write(path, name)
+                os.remove(path)
+    buffer.seek(0)
+    
+    return send_file(
+        buffer,
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name='certificate_of_origin.zip'
+    )
+
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    global _index_cache
+    index_cache = _index_cache
+    if index_cache is None or app.debug:
+        page = minify_html(render_template('index.html')).encode('utf-8')
+        # Maximum compression is too slow per request but costs nothing done once.
+        # Insertion order is the preference order for best_match: br, gzip, none
+        bodies = {}
+        if brotli is not None:
+            bodies['br'] = brotli.compress(page, quality=11)
+        bodies['gzip'] = gzip.compress(page, 9)
+        bodies['identity'] = page
+        index_cache = _index_cache = (bodies, hashlib.sha1(page).hexdigest())
+    bodies, index_etag = index_cache
+    
+    encoding = request.accept_encodings.best_match(list(bodies)) or 'identity'
+    etag = index_etag if encoding == 'identity' else f'{index_etag}-{encoding}'
+    headers = {'Cache-Control': 'public, max-age=300', 'Vary': 'Accept-Encoding'}
+    
+    # Browsers revalidating an unchanged page get a bodiless 304
+    if etag in request.if_none_match:
+        return Response(status=304, headers={**headers, 'ETag': f'"{etag}"'})
+    
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    response = Response(bodies[encoding], mimetype='text/html', headers=headers)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/generate', methods=['POST'])
@@ -58,98 +223,65 @@ def generate_certificate():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
+        if not is_pdf(file):
+            return jsonify({'error': 'Uploaded file is not a PDF'}), 400
+        
         # Save uploaded file temporarily
         filename = secure_filename(file.filename)
-        temp_input = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        temp_input = os.path.join(request_work_dir(), filename)
         file.save(temp_input)
         
         # Extract data using Gemini (model selection is automatic with fallback)
-        extractor = WordGeminiExtractor(api_key)
+        extractor = get_extractor(api_key)
         extracted_data = extractor.extract_from_bill(temp_input)
         
         if not extracted_data:
             os.remove(temp_input)
             return jsonify({'error': 'Failed to extract data from Bill of Lading'}), 400
         
-        print("Extracted data:", json.dumps(extracted_data, indent=2))
-        
-        # Create data objects
-        buyer = BuyerInfo(
-            name=extracted_data.get('buyer', {}).get('name', ''),
-            address=extracted_data.get('buyer', {}).get('address', ''),
-            mobile=extracted_data.get('buyer', {}).get('mobile', ''),
-            tax_number=extracted_data.get('buyer', {}).get('tax_number', ''),
-            email=extracted_data.get('buyer', {}).get('email', '')
-        )
-        
-        seller = SellerInfo(
-            name=extracted_data.get('seller', {}).get('name', ''),
-            address=extracted_data.get('seller', {}).get('address', '')
-        )
-        
-        product = ProductInfo(
-            description=extracted_data.get('product', {}).get('description', ''),
-            hs_code=extracted_data.get('product', {}).get('hs_code', ''),
-            quantity=extracted_data.get('product', {}).get('quantity', ''),
-            weight=extracted_data.get('product', {}).get('weight', ''),
-            marks_numbers=extracted_data.get('product', {}).get('marks_numbers', 'N/M')
-        )
-        
-        shipping = ShippingInfo(
-            port_of_loading=extracted_data.get('shipping', {}).get('port_of_loading', ''),
-            port_of_discharge=extracted_data.get('shipping', {}).get('port_of_discharge', ''),
-            destination_country=extracted_data.get('shipping', {}).get('destination_country', '')
-        )
-        
-        invoice = InvoiceInfo(
-            invoice_number=extracted_data.get('invoice', {}).get('invoice_number', ''),
-            invoice_date=extracted_data.get('invoice', {}).get('invoice_date', '')
-        )
+        debug_dump("Extracted data", extracted_data)
         
         # Generate certificate using Word template
-        generator = WordCertificateGenerator(TEMPLATE_PATH)
-        serial_no, cert_no = generator.generate_certificate_number()
-        declaration_date = generator.generate_declaration_date(invoice.invoice_date)
-        
-        cert_data = CertificateData(
-            buyer=buyer,
-            seller=seller,
-            product=product,
-            shipping=shipping,
-            invoice=invoice,
-            serial_number=serial_no,
-            certificate_number=cert_no,
-            declaration_date=declaration_date
-        )
+        generator = certificate_generator
+        cert_data = generator.build_certificate_data(extracted_data)
         
         # Generate output
-        temp_docx = os.path.join(app.config['UPLOAD_FOLDER'], 'certificate_output.docx')
+        temp_docx = os.path.join(request_work_dir(), 'certificate_output.docx')
         docx_path, pdf_path = generator.create_certificate(cert_data, temp_docx, output_pdf=True)
         
         # Clean up input file
         os.remove(temp_input)
         
-        # Create ZIP file with both Word and PDF
-        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], 'certificate_of_origin.zip')
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            if docx_path and os.path.exists(docx_path):
-                zipf.write(docx_path, 'certificate_of_origin.docx')
-            if pdf_path and os.path.exists(pdf_path):
-                zipf.write(pdf_path, 'certificate_of_origin.pdf')
-        
-        return send_file(
-            zip_path,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='certificate_of_origin.zip'
-        )
+        # Send both Word and PDF as a ZIP
+        return zip_response(docx_path, pdf_path)
         
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
 
+# Fields taken from the Invoice when it has them; everything else comes from the Bill of Lading
+INVOICE_FIELDS = {
+    'invoice': ('invoice_number', 'invoice_date'),
+    'buyer': ('name', 'mobile', 'tax_number', 'email'),
+    'seller': ('name',),
+}
+
+
+def merge_extractions(bill_data, invoice_data):
+    """Merge data: Bill of Lading is primary, Invoice provides invoice info + contact details"""
+    if not bill_data:
+        return invoice_data or {}
+    
+    merged = {section: dict(values) for section, values in bill_data.items()}
+    for section, fields in INVOICE_FIELDS.items():
+        invoice_values = (invoice_data or {}).get(section) or {}
+        for field in fields:
+            if invoice_values.get(field):
+                merged.setdefault(section, {})[field] = invoice_values[field]
+    return merged
+
+
 @app.route('/generate-combined', methods=['POST'])
 def generate_combined():
     """Generate certificate from both Invoice and Bill of Lading using Word template"""
@@ -164,72 +296,50 @@ def generate_combined():
         if not invoice_file and not bill_file:
             return jsonify({'error': 'At least one file (Invoice or Bill) is required'}), 400
         
+        for upload in (invoice_file, bill_file):
+            if upload and upload.filename and not is_pdf(upload):
+                return jsonify({'error': f'{upload.filename} is not a PDF'}), 400
+        
         # Save uploaded files temporarily
         temp_invoice = None
         temp_bill = None
         
         if invoice_file and invoice_file.filename:
             filename = secure_filename(invoice_file.filename)
-            temp_invoice = os.path.join(app.config['UPLOAD_FOLDER'], f'invoice_{filename}')
+            temp_invoice = os.path.join(request_work_dir(), f'invoice_{filename}')
             invoice_file.save(temp_invoice)
         
         if bill_file and bill_file.filename:
             filename = secure_filename(bill_file.filename)
-            temp_bill = os.path.join(app.config['UPLOAD_FOLDER'], f'bill_{filename}')
+            temp_bill = os.path.join(request_work_dir(), f'bill_{filename}')
             bill_file.save(temp_bill)
         
         # Extract data from each document separately
-        extractor = WordGeminiExtractor(api_key)
+        extractor = get_extractor(api_key)
         
         bill_data = {}
         invoice_data = {}
         
-        # Extract from Bill of Lading first (primary source for buyer, seller, product, shipping)
-        if temp_bill:
-            print(f"Extracting from Bill of Lading: {temp_bill}")
-            bill_data = extractor.extract_from_bill(temp_bill)
-            print(f"Bill data: {json.dumps(bill_data, indent=2)}")
-        
-        # Extract from Invoice (only for invoice number and date)
-        if temp_invoice:
-            print(f"Extracting from Invoice: {temp_invoice}")
-            invoice_data = extractor.extract_from_bill(temp_invoice)
-            print(f"Invoice data: {json.dumps(invoice_data, indent=2)}")
-        
-        # Merge data: Bill of Lading is primary, Invoice provides invoice info + contact details
-        if bill_data:
-            extracted_data = bill_data.copy()
-            # Take invoice number and date from invoice document
-            if invoice_data and invoice_data.get('invoice'):
-                if not extracted_data.get('invoice'):
-                    extracted_data['invoice'] = {}
-                if invoice_data['invoice'].get('invoice_number'):
-                    extracted_data['invoice']['invoice_number'] = invoice_data['invoice']['invoice_number']
-                if invoice_data['invoice'].get('invoice_date'):
-                    extracted_data['invoice']['invoice_date'] = invoice_data['invoice']['invoice_date']
-            # Also take buyer name, mobile, tax_number, email from invoice
-            if invoice_data and invoice_data.get('buyer'):
-                if not extracted_data.get('buyer'):
-                    extracted_data['buyer'] = {}
-                if invoice_data['buyer'].get('name'):
-                    extracted_data['buyer']['name'] = invoice_data['buyer']['name']
-                if invoice_data['buyer'].get('mobile'):
-                    extracted_data['buyer']['mobile'] = invoice_data['buyer']['mobile']
-                if invoice_data['buyer'].get('tax_number'):
-                    extracted_data['buyer']['tax_number'] = invoice_data['buyer']['tax_number']
-                if invoice_data['buyer'].get('email'):
-                    extracted_data['buyer']['email'] = invoice_data['buyer']['email']
+        # Both documents go to Gemini at once, so the wait is the slower call, not the sum
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Bill of Lading: primary source for buyer, seller, product, shipping
+            if temp_bill:
+                print(f"Extracting from Bill of Lading: {temp_bill}")
+                bill_future = executor.submit(extractor.extract_from_bill, temp_bill)
+            
+            # Invoice: invoice number and date, buyer contact details
+            if temp_invoice:
+                print(f"Extracting from Invoice: {temp_invoice}")
+                invoice_future = executor.submit(extractor.extract_from_bill, temp_invoice)
             
-            # Take seller name from invoice
-            if invoice_data and invoice_data.get('seller'):
-                if not extracted_data.get('seller'):
-                    extracted_data['seller'] = {}
-                if invoice_data['seller'].get('name'):
-                    extracted_data['seller']['name'] = invoice_data['seller']['name']
-        elif invoice_data:
-            extracted_data = invoice_data
-        else:
-            extracted_data = {}
+            if temp_bill:
+                bill_data = bill_future.result()
+                debug_dump("Bill data", bill_data)
+            if temp_invoice:
+                invoice_data = invoice_future.result()
+                debug_dump("Invoice data", invoice_data)
+        
+        extracted_data = merge_extractions(bill_data, invoice_data)
         
         # Clean up input files
         if temp_invoice and os.path.exists(temp_invoice):
@@ -240,78 +350,20 @@ def generate_combined():
         if not extracted_data:
             return jsonify({'error': 'Failed to extract data from documents'}), 400
         
-        print("Final merged data:", json.dumps(extracted_data, indent=2))
-        
-        # Create data objects
-        buyer = BuyerInfo(
-            name=extracted_data.get('buyer', {}).get('name', ''),
-            address=extracted_data.get('buyer', {}).get('address', ''),
-            mobile=extracted_data.get('buyer', {}).get('mobile', ''),
-            tax_number=extracted_data.get('buyer', {}).get('tax_number', ''),
-            email=extracted_data.get('buyer', {}).get('email', '')
-        )
-        
-        seller = SellerInfo(
-            name=extracted_data.get('seller', {}).get('name', ''),
-            address=extracted_data.get('seller', {}).get('address', '')
-        )
-        
-        product = ProductInfo(
-            description=extracted_data.get('product', {}).get('description', ''),
-            hs_code=extracted_data.get('product', {}).get('hs_code', ''),
-            quantity=extracted_data.get('product', {}).get('quantity', ''),
-            weight=extracted_data.get('product', {}).get('weight', ''),
-            marks_numbers=extracted_data.get('product', {}).get('marks_numbers', 'N/M')
-        )
-        
-        shipping = ShippingInfo(
-            port_of_loading=extracted_data.get('shipping', {}).get('port_of_loading', ''),
-            port_of_discharge=extracted_data.get('shipping', {}).get('port_of_discharge', ''),
-            destination_country=extracted_data.get('shipping', {}).get('destination_country', '')
-        )
-        
-        invoice = InvoiceInfo(
-            invoice_number=extracted_data.get('invoice', {}).get('invoice_number', ''),
-            invoice_date=extracted_data.get('invoice', {}).get('invoice_date', '')
-        )
+        debug_dump("Final merged data", extracted_data)
         
         # Generate certificate using Word template
-        generator = WordCertificateGenerator(TEMPLATE_PATH)
-        serial_no, cert_no = generator.generate_certificate_number()
-        declaration_date = generator.generate_declaration_date(invoice.invoice_date)
-        
-        cert_data = CertificateData(
-            buyer=buyer,
-            seller=seller,
-            product=product,
-            shipping=shipping,
-            invoice=invoice,
-            serial_number=serial_no,
-            certificate_number=cert_no,
-            declaration_date=declaration_date
-        )
+        generator = certificate_generator
+        cert_data = generator.build_certificate_data(extracted_data)
         
         # Generate output
-        temp_docx = os.path.join(app.config['UPLOAD_FOLDER'], 'certificate_combined.docx')
+        temp_docx = os.path.join(request_work_dir(), 'certificate_combined.docx')
         docx_path, pdf_path = generator.create_certificate(cert_data, temp_docx, output_pdf=True)
         
-        # Create ZIP file with both Word and PDF
-        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], 'certificate_of_origin.zip')
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            if docx_path and os.path.exists(docx_path):
-                zipf.write(docx_path, 'certificate_of_origin.docx')
-            if pdf_path and os.path.exists(pdf_path):
-                zipf.write(pdf_path, 'certificate_of_origin.pdf')
-        
-        return send_file(
-            zip_path,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='certificate_of_origin.zip'
-        )
+        # Send both Word and PDF as a ZIP
+        return zip_response(docx_path, pdf_path)
         
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
@@ -351,9 +403,14 @@ def generate_manual():
         # Format invoice date
         invoice_date = request.form.get('invoice_date', '')
         if invoice_date:
-            from datetime import datetime
-            dt = datetime.strptime(invoice_date, '%Y-%m-%d')
-            invoice_date = dt.strftime('%b.%d,%Y').upper()
+            # <input type="date"> submits YYYY-MM-DD; anything else is a client error, not a 500
+            parts = invoice_date.split('-')
+            if not (len(parts) == 3 and all(p.isdigit() for p in parts)):
+                return jsonify({'error': 'invoice_date must be YYYY-MM-DD'}), 400
+            try:
+                invoice_date = date(*map(int, parts)).strftime('%b.%d,%Y').upper()
+            except ValueError:
+                return jsonify({'error': 'invoice_date must be YYYY-MM-DD'}), 400
         
         invoice = InvoiceInfo(
             invoice_number=request.form.get('invoice_number', ''),
@@ -361,7 +418,7 @@ def generate_manual():
         )
         
         # Generate certificate using Word template
-        generator = WordCertificateGenerator(TEMPLATE_PATH)
+        generator = certificate_generator
         serial_no, cert_no = generator.generate_certificate_number()
         declaration_date = generator.generate_declaration_date(invoice_date)
         
@@ -377,29 +434,19 @@ def generate_manual():
         )
         
         # Generate output
-        temp_docx = os.path.join(app.config['UPLOAD_FOLDER'], 'certificate_manual.docx')
+        temp_docx = os.path.join(request_work_dir(), 'certificate_manual.docx')
         docx_path, pdf_path = generator.create_certificate(cert_data, temp_docx, output_pdf=True)
         
-        # Create ZIP file with both Word and PDF
-        zip_path = os.path.join(app.config['UPLOAD_FOLDER'], 'certificate_of_origin.zip')
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            if docx_path and os.path.exists(docx_path):
-                zipf.write(docx_path, 'certificate_of_origin.docx')
-            if pdf_path and os.path.exists(pdf_path):
-                zipf.write(pdf_path, 'certificate_of_origin.pdf')
-        
-        return send_file(
-            zip_path,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='certificate_of_origin.zip'
-        )
+        # Send both Word and PDF as a ZIP
+        return zip_response(docx_path, pdf_path)
         
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server only (set FLASK_DEBUG=1 for the reloader and debugger).
+    # In production serve the app with a WSGI server, e.g.:
+    #   gunicorn -w 2 -k gthread --threads 8 -b 0.0.0.0:5000 web_app:app
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000, threaded=True)
@@ -5,34 +5,232 @@ Uses .docx template for easy text replacement
 Outputs both .docx and .pdf formats
 """
 
+import io
 import os
+import hashlib
 import re
 import json
 import random
+import itertools
 import subprocess
+import tempfile
 import shutil
+import threading
+import time
 from datetime import datetime, timedelta
 from dataclasses import dataclass
 from typing import List, Dict, Optional
 from copy import deepcopy
+from functools import lru_cache
+from bisect import bisect_right
+from itertools import accumulate
 
 from docx import Document
 from docx.shared import Pt, Inches
-import pdfplumber
 
-# For Gemini API
+# orjson parses model output several times faster when installed; stdlib json otherwise
 try:
-    from google import genai
-    USE_NEW_GENAI = True
+    import orjson
+    _json_loads = orjson.loads
 except ImportError:
+    _json_loads = json.loads
+
+# For Gemini API - imported lazily by _load_genai() since the SDK is slow to
+# import and not needed when only filling the Word template
+genai = None
+USE_NEW_GENAI = None
+
+
+def _load_genai():
+    """Import the Gemini SDK on first use, preferring the new google-genai package"""
+    global genai, USE_NEW_GENAI
+    if genai is None:
+        try:
+            from google import genai as genai_module
+            USE_NEW_GENAI = True
+        except ImportError:
+            try:
+                import google.generativeai as genai_module
+                USE_NEW_GENAI = False
+            except ImportError:
+                return None
+        genai = genai_module
+    return genai
+
+
+# Process umask, read once at import (os.umask can only be read by setting it, which
+# is not safe once threads are running); used to give atomically saved files normal permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+# Dedicated RNG for certificate numbers and dates
+_rng = random.Random()
+
+# Certificate numbers come from a counter started at a random offset: one RNG
+# draw per process instead of three per certificate, and no repeats within it
+_certificate_counter = itertools.count(_rng.randrange(900000))
+
+
+def _reseed_after_fork():
+    """Give forked workers (process_bills_batch) their own RNG state and counter start"""
+    global _certificate_counter
+    _rng.seed()
+    _certificate_counter = itertools.count(_rng.randrange(900000))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reseed_after_fork)
+
+
+# Address (host:port) of a running unoserver for PDF conversion, e.g. "127.0.0.1:2003";
+# unset means a fresh LibreOffice process per conversion
+UNOSERVER_ADDRESS = os.environ.get('UNOSERVER_ADDRESS', '')
+
+
+# Invoice date formats: OCT.09,2025 / 09-OCT-2025 / 2025-10-09
+_DATE_FORMATS = ("%b.%d,%Y", "%d-%b-%Y", "%Y-%m-%d")
+
+# Fast path for the usual OCT.09,2025 form, skipping strptime's locale machinery
+_MONTHS = {name: number for number, name in enumerate(
+    ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC'), start=1)}
+_DOTTED_DATE = re.compile(r'([A-Za-z]{3})\.(\d{1,2}),(\d{4})$')
+
+
+@lru_cache(maxsize=256)
+def _parse_invoice_date(date_str: str) -> Optional[datetime]:
+    """Parse an invoice date by picking its format up front (one strptime call, no exception chain)"""
+    if not date_str:
+        return None
+    if '.' in date_str:
+        match = _DOTTED_DATE.match(date_str)
+        month = match and _MONTHS.get(match[1].upper())
+        if month:
+            try:
+                return datetime(int(match[3]), month, int(match[2]))
+            except ValueError:
+                return None
+        fmt = _DATE_FORMATS[0]
+    elif '-' in date_str[1:3]:
+        fmt = _DATE_FORMATS[1]
+    elif len(date_str) > 4 and date_str[4] == '-':
+        fmt = _DATE_FORMATS[2]
+    else:
+        return None
     try:
-        import google.generativeai as genai
-        USE_NEW_GENAI = False
-    except ImportError:
-        USE_NEW_GENAI = None
+        return datetime.strptime(date_str, fmt)
+    except ValueError:
+        return None
+
+
+# Whitespace squeezing for PDF text sent to Gemini (fewer prompt tokens)
+_SPACE_RUNS = re.compile(r'[ \t]+')
+_BLANK_LINES = re.compile(r'\n{3,}')
+MAX_PROMPT_TEXT_CHARS = 8000  # A bill of lading / invoice fits comfortably
+
+# PyMuPDF does not support use from several threads at once, so every fitz.open and
+# page read holds this lock; the Gemini calls that follow still run concurrently
+_FITZ_LOCK = threading.Lock()
+
+# Longest side, in pixels, of a page image sent to Gemini Vision
+MAX_IMAGE_SIDE = 1600
+
+# Lines worth keeping when a document is too long for the prompt (plus a few lines of context each).
+# Whole words only, so TEL does not match HOTEL, PORT TRANSPORT, DATE UPDATE, ...
+_RELEVANT_LINE = re.compile(
+    r'\b(?:SHIPPER|CONSIGNEE|NOTIFY|EXPORTER|BUYER|SELLER|ADDRESS|PORT|DESTINATION|H\.?\s?S\.?\s?CODE|'
+    r'WEIGHT|KGS|CTNS|QUANTITY|DESCRIPTION|INVOICE|DATE|MOBILE|TEL|TAX|EMAIL|MARKS)(?:E?S)?\b',
+    re.IGNORECASE
+)
+RELEVANT_CONTEXT_LINES = 3
 
+# Below this the label filter found too little (e.g. a document without English labels),
+# so the prompt falls back to the plain truncated text
+MIN_RELEVANT_CHARS = 1000
 
-@dataclass
+
+def _keep_relevant_lines(text: str) -> str:
+    """Drop boilerplate (terms and conditions, legalese) far from any field label"""
+    lines = text.split('\n')
+    keep = [False] * len(lines)
+    for i, line in enumerate(lines):
+        if _RELEVANT_LINE.search(line):
+            for j in range(max(0, i - RELEVANT_CONTEXT_LINES), min(len(lines), i + RELEVANT_CONTEXT_LINES + 1)):
+                keep[j] = True
+    return '\n'.join(line for line, kept in zip(lines, keep) if kept)
+
+
+# On-disk cache of extraction results, keyed by document content + prompt.
+# Entries hold buyer details: set CERT_CACHE_DIR to an empty string to disable the
+# cache; entries older than CERT_CACHE_TTL_DAYS are ignored and pruned
+CACHE_DIR = os.environ.get('CERT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cert_origin'))
+CACHE_TTL_SECONDS = float(os.environ.get('CERT_CACHE_TTL_DAYS', '30')) * 86400
+
+# Static part of the extraction prompt; the document text (or an instruction for images) follows it
+EXTRACTION_PROMPT = """
+Extract shipping document information as JSON:
+
+{
+    "buyer": {"name": "", "address": "", "mobile": "", "tax_number": "", "email": ""},
+    "seller": {"name": "", "address": ""},
+    "product": {"description": "", "hs_code": "", "quantity": "", "weight": "", "marks_numbers": "N/M"},
+    "shipping": {"port_of_loading": "", "port_of_discharge": "", "destination_country": ""},
+    "invoice": {"invoice_number": "", "invoice_date": ""}
+}
+
+IMPORTANT DATA SOURCE RULES:
+- From BILL OF LADING: buyer address, seller address, product description, HS code, quantity, weight, shipping ports, destination country
+- From INVOICE: buyer name, seller name, invoice number, invoice date, mobile, tax_number, email
+- Date format: MMM.DD,YYYY (e.g., OCT.09,2025)
+
+Return ONLY valid JSON, no explanation.
+
+"""
+
+# Sections and fields the prompt asks for, with the default for a missing value
+EXTRACTION_FIELDS = {
+    'buyer': {'name': '', 'address': '', 'mobile': '', 'tax_number': '', 'email': ''},
+    'seller': {'name': '', 'address': ''},
+    'product': {'description': '', 'hs_code': '', 'quantity': '', 'weight': '', 'marks_numbers': 'N/M'},
+    'shipping': {'port_of_loading': '', 'port_of_discharge': '', 'destination_country': ''},
+    'invoice': {'invoice_number': '', 'invoice_date': ''},
+}
+
+def _has_extracted_values(data: dict) -> bool:
+    """True if a normalized extraction holds at least one field that differs from its default"""
+    return any(
+        data[section][field] != default
+        for section, fields in EXTRACTION_FIELDS.items()
+        for field, default in fields.items()
+    )
+
+
+# Outermost JSON object inside a response that has extra text around it
+_JSON_OBJECT = re.compile(r'\{.*\}', re.DOTALL)
+
+# Gemini JSON mode: the response body is the JSON object itself
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json", "temperature": 0}
+
+
+@lru_cache(maxsize=16)
+def _placeholder_pattern(placeholders: tuple):
+    """One alternation regex for all placeholders, longest first so e.g. the address wins over 'IRAQ'"""
+    return re.compile('|'.join(re.escape(text) for text in sorted(placeholders, key=len, reverse=True)))
+
+
+@lru_cache(maxsize=4096)
+def _fit_first_line(text: str, max_length: int, stop_at_paren: bool = False) -> str:
+    """Leading words of text that fit in max_length characters (memoized, inputs repeat across certificates)"""
+    line = ""
+    for word in text.split():
+        test = line + (" " if line else "") + word
+        if len(test) > max_length or (stop_at_paren and '(' in word):
+            break
+        line = test
+    return line
+
+
+@dataclass(slots=True)
 class BuyerInfo:
     name: str
     address: str
@@ -41,13 +239,13 @@ class BuyerInfo:
     email: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class SellerInfo:
     name: str
     address: str
 
 
-@dataclass
+@dataclass(slots=True)
 class ProductInfo:
     description: str
     hs_code: str
@@ -56,20 +254,20 @@ class ProductInfo:
     marks_numbers: str = "N/M"
 
 
-@dataclass
+@dataclass(slots=True)
 class ShippingInfo:
     port_of_loading: str
     port_of_discharge: str
     destination_country: str
 
 
-@dataclass
+@dataclass(slots=True)
 class InvoiceInfo:
     invoice_number: str
     invoice_date: str
 
 
-@dataclass
+@dataclass(slots=True)
 class CertificateData:
     buyer: BuyerInfo
     seller: SellerInfo
@@ -141,6 +339,9 @@ class WordCertificateGenerator:
         'signature_label_2': '\nPlace and date,signature and stamp of authorized signatory',
     }
     
+    # Raw template bytes shared by all generators, keyed by template path
+    _template_cache: Dict[str, bytes] = {}
+    
     def __init__(self, template_path: str):
         """
         Initialize with Word template
@@ -150,69 +351,110 @@ class WordCertificateGenerator:
         """
         self.template_path = template_path
     
+    def _load_template(self) -> Document:
+        """Open a fresh copy of the template from cached bytes (read from disk only once)"""
+        template_bytes = self._template_cache.get(self.template_path)
+        if template_bytes is None:
+            with open(self.template_path, 'rb') as f:
+                template_bytes = f.read()
+            self._template_cache[self.template_path] = template_bytes
+        return Document(io.BytesIO(template_bytes))
+    
     def generate_declaration_date(self, invoice_date_str: str) -> str:
         """Generate declaration date 10-30 days after invoice date"""
-        try:
-            invoice_date = datetime.strptime(invoice_date_str, "%b.%d,%Y")
-        except ValueError:
-            try:
-                invoice_date = datetime.strptime(invoice_date_str, "%d-%b-%Y")
-            except ValueError:
-                try:
-                    invoice_date = datetime.strptime(invoice_date_str, "%Y-%m-%d")
-                except ValueError:
-                    invoice_date = datetime.now()
+        invoice_date = _parse_invoice_date(invoice_date_str) or datetime.now()
         
-        random_days = random.randint(10, 30)
+        random_days = _rng.randint(10, 30)
         declaration_date = invoice_date + timedelta(days=random_days)
         return declaration_date.strftime("%b.%d,%Y").upper()
     
     def generate_certificate_number(self) -> tuple:
         """Generate certificate and serial numbers"""
-        serial = f"CCPIT351250{random.randint(100000, 999999)}"
-        cert = f"25C35112{random.randint(1000, 9999)}/000{random.randint(10, 99)}"
+        n = next(_certificate_counter)
+        serial = f"CCPIT351250{100000 + n % 900000}"
+        # The suffix uses the digits above n % 9000, giving 9000 x 90 distinct numbers
+        cert = f"25C35112{1000 + n % 9000}/000{10 + (n // 9000) % 90}"
         return serial, cert
     
-    def _replace_text_in_paragraph(self, paragraph, old_text: str, new_text: str) -> bool:
+    def build_certificate_data(self, extracted: dict) -> CertificateData:
         """
-        Replace text in a paragraph while preserving formatting
-        Returns True if replacement was made
+        Build CertificateData from an extraction result (GeminiExtractor's shape),
+        with a new certificate number and a declaration date after the invoice date
         """
-        # Get full paragraph text
-        full_text = ''.join(run.text for run in paragraph.runs)
+        sections = {
+            section: {field: (extracted.get(section) or {}).get(field, default) for field, default in fields.items()}
+            for section, fields in EXTRACTION_FIELDS.items()
+        }
+        invoice = InvoiceInfo(**sections['invoice'])
+        serial_no, cert_no = self.generate_certificate_number()
         
-        if old_text in full_text:
-            # Find which runs contain the text
-            new_full_text = full_text.replace(old_text, new_text)
-            
-            # Clear all runs and set new text in first run
-            if paragraph.runs:
-                # Preserve formatting from first run
-                first_run = paragraph.runs[0]
-                
-                # Clear all runs
-                for i, run in enumerate(paragraph.runs):
-                    if i == 0:
-                        run.text = new_full_text
-                    else:
-                        run.text = ''
-                
-                return True
+        return CertificateData(
+            buyer=BuyerInfo(**sections['buyer']),
+            seller=SellerInfo(**sections['seller']),
+            product=ProductInfo(**sections['product']),
+            shipping=ShippingInfo(**sections['shipping']),
+            invoice=invoice,
+            serial_number=serial_no,
+            certificate_number=cert_no,
+            declaration_date=self.generate_declaration_date(invoice.invoice_date)
+        )
+    
+    def _replace_text_in_paragraph(self, paragraph, pattern, replacements: dict) -> bool:
+        """
+        Replace every placeholder matched by pattern in a single scan while preserving formatting
+        Returns True if any replacement was made
+        """
+        runs = paragraph.runs
+        if not runs:
+            return False
         
-        return False
+        texts = [run.text for run in runs]
+        full_text = ''.join(texts)
+        matches = list(pattern.finditer(full_text))
+        if not matches:
+            return False
+        
+        substitute = lambda match: replacements[match.group()]
+        
+        # Offset where each run ends, to tell whether a match stays inside one run
+        run_ends = list(accumulate(len(text) for text in texts))
+        
+        # Every placeholder sits inside a single run: edit those runs in place (keeps each run's formatting)
+        if all(bisect_right(run_ends, match.start()) == bisect_right(run_ends, match.end() - 1)
+               for match in matches):
+            for run, text in zip(runs, texts):
+                new_text = pattern.sub(substitute, text)
+                if new_text != text:
+                    run.text = new_text
+            return True
+        
+        # A placeholder spans runs: put the new text in the first run (keeps its formatting) and clear the rest
+        runs[0].text = pattern.sub(substitute, full_text)
+        for run in runs[1:]:
+            run.text = ''
+        
+        return True
     
-    def _replace_in_document(self, doc: Document, old_text: str, new_text: str):
-        """Replace text throughout the document"""
-        # Replace in paragraphs
-        for paragraph in doc.paragraphs:
-            self._replace_text_in_paragraph(paragraph, old_text, new_text)
+    def _iter_paragraphs(self, doc: Document):
+        """Yield each paragraph in the body and tables once (merged cells repeat in row.cells)"""
+        yield from doc.paragraphs
         
-        # Replace in tables
+        seen = set()
         for table in doc.tables:
             for row in table.rows:
                 for cell in row.cells:
-                    for paragraph in cell.paragraphs:
-                        self._replace_text_in_paragraph(paragraph, old_text, new_text)
+                    if cell._tc in seen:
+                        continue
+                    seen.add(cell._tc)
+                    yield from cell.paragraphs
+    
+    def _replace_in_document(self, doc: Document, replacements: dict):
+        """Replace text throughout the document in a single walk over its paragraphs"""
+        if not replacements:
+            return
+        pattern = _placeholder_pattern(tuple(replacements))
+        for paragraph in self._iter_paragraphs(doc):
+            self._replace_text_in_paragraph(paragraph, pattern, replacements)
     
     def create_certificate(self, data: CertificateData, output_path: str, output_pdf: bool = True):
         """
@@ -224,7 +466,7 @@ class WordCertificateGenerator:
             output_pdf: Also create PDF version
         """
         # Load template
-        doc = Document(self.template_path)
+        doc = self._load_template()
         
         # Build replacement mapping
         replacements = {
@@ -264,28 +506,41 @@ class WordCertificateGenerator:
             self.REPLACEMENTS['weight']: data.product.weight,
             
             # Invoice
-            self.REPLACEMENTS['invoice_no_1']: data.invoice.invoice_number[:12] if len(data.invoice.invoice_number) > 12 else data.invoice.invoice_number,
-            self.REPLACEMENTS['invoice_no_2']: data.invoice.invoice_number[12:] if len(data.invoice.invoice_number) > 12 else "",
+            # (the template splits it after 12 characters; shorter numbers give "" for line 2)
+            self.REPLACEMENTS['invoice_no_1']: data.invoice.invoice_number[:12],
+            self.REPLACEMENTS['invoice_no_2']: data.invoice.invoice_number[12:],
             self.REPLACEMENTS['invoice_date']: data.invoice.invoice_date,
             
             # Declaration date (appears twice)
             self.REPLACEMENTS['declaration_date']: data.declaration_date,
         }
         
-        # Perform replacements
-        for old_text, new_text in replacements.items():
-            if old_text and new_text is not None:
-                self._replace_in_document(doc, old_text, new_text)
-        
         # Remove signature/stamp labels (replace with empty string)
-        self._replace_in_document(doc, self.REPLACEMENTS['signature_label_1'], '')
-        self._replace_in_document(doc, self.REPLACEMENTS['signature_label_2'], '')
+        replacements[self.REPLACEMENTS['signature_label_1']] = ''
+        replacements[self.REPLACEMENTS['signature_label_2']] = ''
+        
+        # Perform all replacements in one pass over the document. Identity pairs (e.g.
+        # 'IRAQ' when the destination is Iraq) are dropped so they neither widen the
+        # regex nor make unchanged paragraphs look like matches
+        replacements = {old_text: new_text for old_text, new_text in replacements.items()
+                        if old_text and new_text is not None and new_text != old_text}
+        self._replace_in_document(doc, replacements)
         
         # Handle marks separately (it's just "N/M" which appears in headers too)
         # Only replace in the specific table cell
         
-        # Save Word document
-        doc.save(output_path)
+        # Save Word document (large buffer: the zip writer issues many small writes).
+        # Write to a temp file and rename so an interrupted run never leaves a corrupt .docx
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix='.docx.tmp')
+        try:
+            with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+                doc.save(f)
+            # mkstemp creates the file 0600; give it the permissions a normal open() would
+            os.chmod(temp_path, 0o666 & ~_UMASK)
+            os.replace(temp_path, output_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
         print(f"Word document generated: {output_path}")
         
         # Convert to PDF if requested
@@ -298,14 +553,7 @@ class WordCertificateGenerator:
     
     def _get_consignee_name_part1(self, full_name: str) -> str:
         """Get first part of consignee name (fits first line)"""
-        words = full_name.split()
-        line = ""
-        for word in words:
-            test = line + (" " if line else "") + word
-            if len(test) > 75:
-                break
-            line = test
-        return line
+        return _fit_first_line(full_name, 75)
     
     def _get_consignee_name_part2(self, full_name: str) -> str:
         """Get second part of consignee name"""
@@ -318,14 +566,7 @@ class WordCertificateGenerator:
         if len(address) <= 60:
             return address
         # Find a good break point
-        words = address.split()
-        line = ""
-        for word in words:
-            test = line + (" " if line else "") + word
-            if len(test) > 60:
-                break
-            line = test
-        return line
+        return _fit_first_line(address, 60)
     
     def _get_address_part2(self, address: str) -> str:
         """Get second part of address"""
@@ -338,14 +579,7 @@ class WordCertificateGenerator:
     def _get_product_part1(self, description: str) -> str:
         """Get first part of product description"""
         # Usually quantity in words
-        words = description.split()
-        line = ""
-        for word in words:
-            test = line + (" " if line else "") + word
-            if len(test) > 20 or '(' in word:
-                break
-            line = test
-        return line
+        return _fit_first_line(description, 20, stop_at_paren=True)
     
     def _get_product_part2(self, description: str) -> str:
         """Get second part of product description"""
@@ -367,6 +601,11 @@ class WordCertificateGenerator:
         except Exception as e:
             print(f"docx2pdf failed: {e}")
         
+        # A running unoserver keeps LibreOffice loaded, skipping its start-up per document
+        if UNOSERVER_ADDRESS and self._convert_with_unoserver(docx_path, pdf_path):
+            print(f"PDF generated: {pdf_path}")
+            return True
+        
         # Fallback to LibreOffice (Linux/Mac or if Word not available)
         try:
             output_dir = os.path.dirname(pdf_path) or '.'
@@ -384,7 +623,171 @@ class WordCertificateGenerator:
             else:
                 print("Install LibreOffice for PDF conversion: apt install libreoffice")
             return False
+    
+    def _convert_with_unoserver(self, docx_path: str, pdf_path: str) -> bool:
+        """Convert through the unoserver at UNOSERVER_ADDRESS (host:port) with its unoconvert client"""
+        host, _, port = UNOSERVER_ADDRESS.rpartition(':')
+        try:
+            subprocess.run([
+                'unoconvert', '--host', host or '127.0.0.1', '--port', port,
+                '--convert-to', 'pdf', docx_path, pdf_path
+            ], check=True, capture_output=True, timeout=120)
+            return True
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
+            print(f"unoserver conversion failed, starting LibreOffice instead: {e}")
+            return False
+    
+    def convert_to_pdf_batch(self, docx_paths: List[str]) -> List[Optional[str]]:
+        """
+        Convert many Word documents to PDF, starting LibreOffice once per output folder
+        instead of once per document. Returns the PDF path (or None) for each input
+        """
+        pdf_paths = [docx_path.rsplit('.', 1)[0] + '.pdf' for docx_path in docx_paths]
+        
+        # docx2pdf (Word) has no startup cost worth batching - convert one by one
+        try:
+            import docx2pdf  # noqa: F401
+            return [pdf_path if self._convert_to_pdf(docx_path, pdf_path) else None
+                    for docx_path, pdf_path in zip(docx_paths, pdf_paths)]
+        except ImportError:
+            pass
+        
+        # Clear old PDFs at the target paths so the existence check below only
+        # reports files this run produced
+        for pdf_path in pdf_paths:
+            try:
+                os.remove(pdf_path)
+            except FileNotFoundError:
+                pass
+        
+        by_dir = {}
+        for docx_path in docx_paths:
+            by_dir.setdefault(os.path.dirname(docx_path) or '.', []).append(docx_path)
+        
+        try:
+            for output_dir, paths in by_dir.items():
+                subprocess.run([
+                    'soffice', '--headless', '--convert-to', 'pdf',
+                    '--outdir', output_dir,
+                    *paths
+                ], check=True, capture_output=True)
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"Warning: Could not convert to PDF: {e}")
+            print("Install LibreOffice for PDF conversion: apt install libreoffice")
+        
+        return [pdf_path if os.path.exists(pdf_path) else None for pdf_path in pdf_paths]
+
+
 
+# Rough prompt size for rate limiting: ~4 characters per token, and a page image
+# of up to MAX_IMAGE_SIDE pixels tiles into about six 258-token tiles
+ESTIMATED_IMAGE_TOKENS = 1548
+
+
+def _estimate_tokens(contents) -> int:
+    """Estimate the input tokens of a prompt, or of a [prompt, image] list"""
+    parts = contents if isinstance(contents, list) else [contents]
+    return sum(len(part) // 4 if isinstance(part, str) else ESTIMATED_IMAGE_TOKENS for part in parts)
+
+
+# When models fail with quota errors, retry the whole model list this many times,
+# waiting 2, 4, ... seconds first (a single 429 usually clears within seconds)
+RATE_LIMIT_RETRIES = 2
+RATE_LIMIT_BACKOFF_SECONDS = 2.0
+# Upper bound on the time one extraction spends waiting for quota or backing off
+RATE_LIMIT_MAX_WAIT_SECONDS = 30.0
+
+
+def _error_status(error: Exception) -> Optional[int]:
+    """HTTP status of an SDK error (google-genai APIError.code, api_core .code / .status_code), if any"""
+    for attr in ('code', 'status_code'):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    """True for Gemini quota errors (HTTP 429 / RESOURCE_EXHAUSTED)"""
+    status = _error_status(error)
+    if status is not None:
+        return status == 429
+    message = str(error)
+    return 'RESOURCE_EXHAUSTED' in message or re.search(r'\b429\b', message) is not None
+
+
+def _is_missing_model_error(error: Exception) -> bool:
+    """
+    True when the API does not serve the model at all (HTTP 404 / NOT_FOUND)
+    Quota errors never count, even if their text happens to contain 404 ("retry in 17.404s")
+    """
+    if _is_rate_limit_error(error):
+        return False
+    status = _error_status(error)
+    if status is not None:
+        return status == 404
+    message = str(error)
+    return 'NOT_FOUND' in message or re.search(r'\b404\b', message) is not None
+
+
+class TokenBucket:
+    """
+    Per-minute request and token budget for one API key
+    Shared by every GeminiExtractor using that key, so concurrent calls queue
+    instead of all hitting Gemini and failing with quota errors
+    """
+    
+    def __init__(self, requests_per_minute: int = 15, tokens_per_minute: int = 250000):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self._requests = self.request_capacity
+        self._tokens = self.token_capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.request_capacity, self._requests + elapsed * self.request_capacity / 60)
+        self._tokens = min(self.token_capacity, self._tokens + elapsed * self.token_capacity / 60)
+    
+    def _try_acquire(self, tokens: int) -> float:
+        """Take one request and the tokens if available, otherwise return the seconds to wait"""
+        tokens = min(tokens, self.token_capacity)
+        with self._lock:
+            self._refill()
+            if self._requests >= 1 and self._tokens >= tokens:
+                self._requests -= 1
+                self._tokens -= tokens
+                return 0.0
+            return max((1 - self._requests) * 60 / self.request_capacity,
+                       (tokens - self._tokens) * 60 / self.token_capacity)
+    
+    def acquire(self, tokens: int = 0, deadline: float = None) -> bool:
+        """
+        Block until one request and the estimated tokens fit in the budget
+        Returns False without waiting when the budget would not free up before deadline (time.monotonic())
+        """
+        while (wait := self._try_acquire(tokens)) > 0:
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+        return True
+    
+    async def aacquire(self, tokens: int = 0, deadline: float = None) -> bool:
+        """acquire() for asyncio callers"""
+        import asyncio
+        while (wait := self._try_acquire(tokens)) > 0:
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+        return True
+    
+    def record_usage(self, estimated: int, actual: int):
+        """Charge (or refund) the difference between the estimated and reported token usage"""
+        with self._lock:
+            self._tokens = min(self.token_capacity, self._tokens + estimated - actual)
 
 
 class GeminiExtractor:
@@ -405,8 +808,16 @@ class GeminiExtractor:
         'gemma-3-1b',
     ]
     
-    def __init__(self, api_key: str = None):
-        """Initialize with API key - loads from .env if not provided"""
+    # Shared by all extractors in the process: models the API reported as missing are
+    # skipped from then on, and the last model that answered is tried first
+    _unavailable_models = set()
+    _last_success_model = None
+    
+    def __init__(self, api_key: str = None, rate_limiter: TokenBucket = None):
+        """
+        Initialize with API key - loads from .env if not provided
+        Pass a TokenBucket to keep Gemini calls within the key's per-minute quota
+        """
         if api_key is None:
             from dotenv import load_dotenv
             load_dotenv()
@@ -416,86 +827,402 @@ class GeminiExtractor:
             raise ValueError("GEMINI_API_KEY not set. Please set it in .env file or pass directly.")
         
         self.api_key = api_key
+        self.rate_limiter = rate_limiter
         
+        _load_genai()
+        # Bind the SDK-specific call once instead of branching on every request
         if USE_NEW_GENAI is True:
             self.client = genai.Client(api_key=api_key)
+            self._generate = self._generate_new
         elif USE_NEW_GENAI is False:
             genai.configure(api_key=api_key)
+            self._generate = self._generate_legacy
         else:
             raise ImportError("Google Generative AI package not installed")
     
+    def _generate_new(self, model_name: str, contents, config):
+        """generate_content through the google-genai client"""
+        return self.client.models.generate_content(model=model_name, contents=contents, config=config)
+    
+    def _generate_legacy(self, model_name: str, contents, config):
+        """generate_content through the legacy google-generativeai package"""
+        return genai.GenerativeModel(model_name, generation_config=config).generate_content(contents)
+    
+    def _generation_config(self, model_name: str) -> Optional[dict]:
+        """
+        Ask Gemini models for raw JSON output (no code fences or commentary to strip)
+        Gemma models do not support JSON mode, so they keep the plain-text response
+        """
+        if model_name.startswith('gemini'):
+            return JSON_GENERATION_CONFIG
+        return None
+    
+    def _record_usage(self, response, estimated: int):
+        """Feed the token count Gemini reports back to the rate limiter"""
+        usage = getattr(response, 'usage_metadata', None)
+        actual = getattr(usage, 'prompt_token_count', None)
+        if self.rate_limiter and actual:
+            self.rate_limiter.record_usage(estimated, actual)
+    
+    def _acquire_quota(self, contents, deadline: float) -> int:
+        """
+        Take one request from the rate limiter for an extraction (not per fallback model)
+        Returns the estimated tokens so the caller can settle them against the real usage
+        """
+        estimated = _estimate_tokens(contents)
+        if self.rate_limiter and not self.rate_limiter.acquire(estimated, deadline):
+            raise Exception("Gemini rate limit: no quota available within the wait limit")
+        return estimated
+    
+    def _models_to_try(self) -> List[str]:
+        """MODELS without the ones known to be missing, last successful model first"""
+        models = [m for m in self.MODELS if m not in self._unavailable_models] or list(self.MODELS)
+        preferred = GeminiExtractor._last_success_model
+        if preferred in models:
+            models.remove(preferred)
+            models.insert(0, preferred)
+        return models
+    
+    def _note_model_result(self, model_name: str, error: Exception = None,
+                           response=None, estimated: int = 0) -> bool:
+        """
+        Per-attempt bookkeeping for the fallback loops: remember which model answered and settle
+        its token usage, or that a model does not exist (a quota error never blacklists)
+        Returns True when the attempt failed on a quota error
+        """
+        if error is None:
+            print(f"Success with model: {model_name}")
+            GeminiExtractor._last_success_model = model_name
+            self._record_usage(response, estimated)
+            return False
+        
+        print(f"Model {model_name} failed: {str(error)[:100]}")
+        if _is_rate_limit_error(error):
+            return True
+        if _is_missing_model_error(error):
+            self._unavailable_models.add(model_name)
+        return False
+    
+    @staticmethod
+    def _backoff_delay(attempt: int, deadline: float) -> Optional[float]:
+        """Seconds to wait before retry `attempt` of the model list, or None once that would pass deadline"""
+        delay = RATE_LIMIT_BACKOFF_SECONDS * 2 ** (attempt - 1)
+        if time.monotonic() + delay > deadline:
+            return None
+        print(f"Rate limited, retrying all models in {delay:.0f}s")
+        return delay
+    
     def _call_with_fallback(self, prompt, image=None):
-        """Try each model until one works"""
+        """
+        Try each model until one works
+        If models were rate limited, the whole list is retried after an exponential backoff,
+        for at most RATE_LIMIT_MAX_WAIT_SECONDS including the wait for rate limiter quota
+        """
         last_error = None
+        contents = [prompt, image] if image else prompt
+        deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT_SECONDS
+        estimated = self._acquire_quota(contents, deadline)
         
-        for model_name in self.MODELS:
-            try:
-                print(f"Trying model: {model_name}")
-                
-                if USE_NEW_GENAI:
-                    if image:
-                        response = self.client.models.generate_content(
-                            model=model_name,
-                            contents=[prompt, image]
-                        )
-                    else:
-                        response = self.client.models.generate_content(
-                            model=model_name,
-                            contents=prompt
-                        )
-                else:
-                    model = genai.GenerativeModel(model_name)
-                    if image:
-                        response = model.generate_content([prompt, image])
-                    else:
-                        response = model.generate_content(prompt)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            if attempt:
+                delay = self._backoff_delay(attempt, deadline)
+                if delay is None:
+                    break
+                time.sleep(delay)
+            
+            rate_limited = False
+            for model_name in self._models_to_try():
+                try:
+                    print(f"Trying model: {model_name}")
+                    response = self._generate(model_name, contents, self._generation_config(model_name))
+                except Exception as e:
+                    last_error = e
+                    rate_limited = self._note_model_result(model_name, e) or rate_limited
+                    continue
                 
-                # If we got here, the model worked
-                print(f"Success with model: {model_name}")
+                self._note_model_result(model_name, response=response, estimated=estimated)
                 return response
-                
-            except Exception as e:
-                last_error = e
-                print(f"Model {model_name} failed: {str(e)[:100]}")
-                continue
+            
+            if not rate_limited:
+                break
         
         # All models failed
         raise Exception(f"All models failed. Last error: {last_error}")
     
-    def extract_from_bill(self, pdf_path: str) -> dict:
-        text_content = self._extract_pdf_text(pdf_path)
+    def extract_from_bill(self, pdf_path: str, force_refresh: bool = False) -> dict:
+        """Extract data from a document, reusing the cached result for identical content"""
+        cache_path = self._get_cache_path(pdf_path)
+        if not force_refresh:
+            cached = self._read_cache(cache_path)
+            if cached:
+                print(f"Using cached extraction for: {pdf_path}")
+                return cached
+        
+        text_content, image = self._read_pdf(pdf_path)
         
         if not text_content.strip():
-            return self._extract_from_pdf_image(pdf_path)
+            result = self._extract_from_pdf_image(pdf_path, image)
+        else:
+            result = self._extract_from_text(text_content)
         
-        return self._extract_from_text(text_content)
+        return self._store_result(cache_path, result)
+    
+    def _store_result(self, cache_path: Optional[str], result: dict) -> dict:
+        """Cache a finished extraction and return it; only real extractions are cached, a miss is retried next time"""
+        if cache_path and result and _has_extracted_values(result):
+            self._write_cache(cache_path, result)
+        return result
+    
+    def _get_cache_path(self, pdf_path: str) -> Optional[str]:
+        """Cache file for a document: SHA-256 of its bytes plus the prompt, so prompt edits invalidate it"""
+        if not CACHE_DIR:
+            return None
+        try:
+            digest = hashlib.sha256(EXTRACTION_PROMPT.encode('utf-8'))
+            with open(pdf_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return os.path.join(CACHE_DIR, f"{digest.hexdigest()}.json")
+    
+    def _read_cache(self, cache_path: Optional[str]) -> dict:
+        """Cached extraction result, or {} when there is none (or it has expired)"""
+        if not cache_path or not os.path.exists(cache_path):
+            return {}
+        try:
+            if time.time() - os.path.getmtime(cache_path) > CACHE_TTL_SECONDS:
+                os.remove(cache_path)
+                return {}
+            with open(cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+            return data if _has_extracted_values(data) else {}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+    
+    def _write_cache(self, cache_path: str, result: dict):
+        """Write a cache entry atomically so concurrent readers never see a partial file"""
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"Could not write extraction cache: {e}")
+        self._prune_cache()
+    
+    def _prune_cache(self):
+        """Delete cache entries past CACHE_TTL_SECONDS so the cache does not grow without bound"""
+        cutoff = time.time() - CACHE_TTL_SECONDS
+        try:
+            with os.scandir(CACHE_DIR) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+        except OSError:
+            pass
+    
+    def _read_pdf(self, pdf_path: str) -> tuple:
+        """
+        Open the PDF once and return (text, image)
+        The first page is only rendered to an image when there is no text layer
+        """
+        try:
+            import fitz  # PyMuPDF
+        except ImportError:
+            return self._extract_pdf_text(pdf_path), None
+        
+        try:
+            with _FITZ_LOCK, fitz.open(pdf_path) as doc:
+                text_content = self._get_doc_text(doc)
+                image = None if text_content.strip() else self._render_first_page(doc)
+            return text_content, image
+        except Exception as e:
+            print(f"PyMuPDF could not read {pdf_path}: {str(e)[:100]}")
+            return "", None
+    
+    def extract_from_bills_batch(self, pdf_paths: List[str], max_workers: int = 8) -> List[dict]:
+        """
+        Extract several documents concurrently (Gemini calls are network-bound)
+        
+        Results are in input order; a document that fails yields {} like extract_from_bill
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        def extract_one(pdf_path):
+            try:
+                return self.extract_from_bill(pdf_path)
+            except Exception as e:
+                print(f"Extraction failed for {pdf_path}: {str(e)[:100]}")
+                return {}
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(extract_one, pdf_paths))
+    
+    async def aextract_from_bill(self, pdf_path: str) -> dict:
+        """
+        Async variant of extract_from_bill: PDF work runs in a worker thread and text
+        prompts go through the SDK's async client so many documents can be in flight
+        """
+        import asyncio
+        
+        cache_path = await asyncio.to_thread(self._get_cache_path, pdf_path)
+        cached = self._read_cache(cache_path)
+        if cached:
+            print(f"Using cached extraction for: {pdf_path}")
+            return cached
+        
+        text_content, image = await asyncio.to_thread(self._read_pdf, pdf_path)
+        
+        if not text_content.strip():
+            result = await asyncio.to_thread(self._extract_from_pdf_image, pdf_path, image)
+        elif USE_NEW_GENAI:
+            response = await self._acall_with_fallback(self._get_text_prompt(text_content))
+            result = self._parse_response(response)
+        else:
+            result = await asyncio.to_thread(self._extract_from_text, text_content)
+        
+        return self._store_result(cache_path, result)
+    
+    async def aextract_from_bills(self, pdf_paths: List[str], concurrency: int = 8) -> List[dict]:
+        """Extract documents concurrently with at most `concurrency` in flight; results in input order"""
+        import asyncio
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def extract_one(pdf_path):
+            async with semaphore:
+                try:
+                    return await self.aextract_from_bill(pdf_path)
+                except Exception as e:
+                    print(f"Extraction failed for {pdf_path}: {str(e)[:100]}")
+                    return {}
+        
+        return list(await asyncio.gather(*(extract_one(pdf_path) for pdf_path in pdf_paths)))
+    
+    async def _acall_with_fallback(self, prompt):
+        """Async _call_with_fallback through the google-genai client's aio interface"""
+        import asyncio
+        last_error = None
+        deadline = time.monotonic() + RATE_LIMIT_MAX_WAIT_SECONDS
+        estimated = _estimate_tokens(prompt)
+        if self.rate_limiter and not await self.rate_limiter.aacquire(estimated, deadline):
+            raise Exception("Gemini rate limit: no quota available within the wait limit")
+        
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            if attempt:
+                delay = self._backoff_delay(attempt, deadline)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+            
+            rate_limited = False
+            for model_name in self._models_to_try():
+                try:
+                    print(f"Trying model: {model_name}")
+                    response = await self.client.aio.models.generate_content(
+                        model=model_name,
+                        contents=prompt,
+                        config=self._generation_config(model_name)
+                    )
+                except Exception as e:
+                    last_error = e
+                    rate_limited = self._note_model_result(model_name, e) or rate_limited
+                    continue
+                
+                self._note_model_result(model_name, response=response, estimated=estimated)
+                return response
+            
+            if not rate_limited:
+                break
+        
+        raise Exception(f"All models failed. Last error: {last_error}")
+    
+    def extract_with_batch_mode(self, pdf_paths: List[str], model_name: str = 'gemini-2.5-flash',
+                                poll_seconds: int = 30) -> List[dict]:
+        """
+        Extract many documents through Gemini Batch Mode (half the token price, higher
+        rate limits, but results can take hours - for back-office bulk runs only)
+        
+        Documents without a text layer are extracted the normal way. Results are in input order
+        """
+        if not USE_NEW_GENAI:
+            raise ImportError("Gemini Batch Mode requires the google-genai package")
+        
+        results = [{} for _ in pdf_paths]
+        batched = []  # indexes of documents submitted to the batch job
+        requests = []
+        for i, pdf_path in enumerate(pdf_paths):
+            text_content, image = self._read_pdf(pdf_path)
+            if not text_content.strip():
+                results[i] = self._extract_from_pdf_image(pdf_path, image)
+                continue
+            batched.append(i)
+            requests.append({
+                'contents': [{'role': 'user', 'parts': [{'text': self._get_text_prompt(text_content)}]}],
+                'config': JSON_GENERATION_CONFIG,
+            })
+        
+        if not requests:
+            return results
+        
+        batch_job = self.client.batches.create(
+            model=model_name,
+            src=requests,
+            config={'display_name': f"certificate-extraction-{datetime.now():%Y%m%d-%H%M%S}"}
+        )
+        print(f"Submitted batch job {batch_job.name} with {len(requests)} documents")
+        
+        finished_states = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+        while batch_job.state.name not in finished_states:
+            time.sleep(poll_seconds)
+            batch_job = self.client.batches.get(name=batch_job.name)
+        
+        if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+            print(f"Batch job {batch_job.name} ended with {batch_job.state.name}")
+            return results
+        
+        for i, inline_response in zip(batched, batch_job.dest.inlined_responses):
+            if inline_response.response:
+                results[i] = self._parse_response(inline_response.response)
+            else:
+                print(f"Batch extraction failed for {pdf_paths[i]}: {inline_response.error}")
+        
+        return results
+    
+    def _get_text_prompt(self, text_content: str) -> str:
+        """Prompt for a document's text, whitespace-squeezed and trimmed to keep tokens down"""
+        text_content = _SPACE_RUNS.sub(' ', text_content)
+        text_content = _BLANK_LINES.sub('\n\n', text_content)
+        if len(text_content) > MAX_PROMPT_TEXT_CHARS:
+            relevant = _keep_relevant_lines(text_content)
+            if len(relevant) >= MIN_RELEVANT_CHARS:
+                text_content = relevant
+        text_content = text_content[:MAX_PROMPT_TEXT_CHARS]
+        return self._get_extraction_prompt(f"Bill of Lading Content:\n{text_content}")
     
     def _extract_from_text(self, text_content: str) -> dict:
-        prompt = self._get_extraction_prompt(f"Bill of Lading Content:\n{text_content}")
+        prompt = self._get_text_prompt(text_content)
         response = self._call_with_fallback(prompt)
         return self._parse_response(response)
     
-    def _extract_from_pdf_image(self, pdf_path: str) -> dict:
-        """Extract from PDF by converting to image using PyMuPDF (pure Python, no external deps)"""
+    def _extract_from_pdf_image(self, pdf_path: str, image=None) -> dict:
+        """
+        Extract from PDF by converting to image using PyMuPDF (pure Python, no external deps)
+        Pass image when the first page has already been rendered to skip re-opening the PDF
+        """
         
         # Try PyMuPDF first (pure Python, works everywhere)
         try:
-            print(f"Trying PyMuPDF conversion for: {pdf_path}")
-            import fitz  # PyMuPDF
-            import io
-            import PIL.Image
-            
-            doc = fitz.open(pdf_path)
-            if len(doc) > 0:
-                page = doc[0]  # First page
-                # Render at higher resolution for better OCR
-                mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better quality
-                pix = page.get_pixmap(matrix=mat)
-                
-                # Convert to PIL Image
-                img_data = pix.tobytes("png")
-                image = PIL.Image.open(io.BytesIO(img_data))
+            if image is None:
+                print(f"Trying PyMuPDF conversion for: {pdf_path}")
+                import fitz  # PyMuPDF
                 
+                with _FITZ_LOCK, fitz.open(pdf_path) as doc:
+                    image = self._render_first_page(doc)
+            
+            if image is not None:
                 print(f"PyMuPDF: Converted PDF to {image.size[0]}x{image.size[1]} image")
                 
                 prompt = self._get_extraction_prompt("Analyze this Bill of Lading image and extract all shipping information.")
@@ -504,7 +1231,6 @@ class GeminiExtractor:
                 if result:
                     print("Success with PyMuPDF image extraction!")
                     return result
-            doc.close()
         except Exception as e:
             print(f"PyMuPDF extraction failed: {str(e)[:100]}")
         
@@ -517,27 +1243,27 @@ class GeminiExtractor:
                 
                 from google.genai import types
                 prompt = self._get_extraction_prompt("Extract all information from this Bill of Lading PDF document.")
+                contents = [
+                    types.Content(
+                        parts=[
+                            types.Part.from_bytes(data=pdf_content, mime_type='application/pdf'),
+                            types.Part.from_text(text=prompt)
+                        ]
+                    )
+                ]
+                estimated = self._acquire_quota(contents, time.monotonic() + RATE_LIMIT_MAX_WAIT_SECONDS)
                 
-                for model_name in self.MODELS:
+                for model_name in self._models_to_try():
                     try:
                         print(f"Trying model with PDF: {model_name}")
-                        response = self.client.models.generate_content(
-                            model=model_name,
-                            contents=[
-                                types.Content(
-                                    parts=[
-                                        types.Part.from_bytes(data=pdf_content, mime_type='application/pdf'),
-                                        types.Part.from_text(text=prompt)
-                                    ]
-                                )
-                            ]
-                        )
+                        response = self._generate(model_name, contents, self._generation_config(model_name))
                         result = self._parse_response(response)
                         if result:
+                            self._record_usage(response, estimated)
                             print(f"Success with PDF upload using model: {model_name}")
                             return result
                     except Exception as e:
-                        print(f"PDF upload failed with {model_name}: {str(e)[:100]}")
+                        self._note_model_result(model_name, e)
                         continue
         except Exception as e:
             print(f"Gemini native PDF upload failed: {str(e)[:100]}")
@@ -545,54 +1271,120 @@ class GeminiExtractor:
         return {}
     
     def _get_extraction_prompt(self, context: str) -> str:
-        return f"""
-Extract shipping document information as JSON:
-
-{{
-    "buyer": {{"name": "", "address": "", "mobile": "", "tax_number": "", "email": ""}},
-    "seller": {{"name": "", "address": ""}},
-    "product": {{"description": "", "hs_code": "", "quantity": "", "weight": "", "marks_numbers": "N/M"}},
-    "shipping": {{"port_of_loading": "", "port_of_discharge": "", "destination_country": ""}},
-    "invoice": {{"invoice_number": "", "invoice_date": ""}}
-}}
-
-IMPORTANT DATA SOURCE RULES:
-- From BILL OF LADING: buyer address, seller address, product description, HS code, quantity, weight, shipping ports, destination country
-- From INVOICE: buyer name, seller name, invoice number, invoice date, mobile, tax_number, email
-- Date format: MMM.DD,YYYY (e.g., OCT.09,2025)
-
-Return ONLY valid JSON, no explanation.
-
-{context}
-"""
+        return f"{EXTRACTION_PROMPT}{context}\n"
     
     def _parse_response(self, response) -> dict:
         try:
             text = response.text.strip()
-            if text.startswith("```"):
-                text = re.sub(r'^```json?\n?', '', text)
-                text = re.sub(r'\n?```$', '', text)
-            return json.loads(text)
-        except:
+        except Exception:
             return {}
+        
+        data = self._loads_json(text)
+        if not isinstance(data, dict) or not data:
+            return {}
+        normalized = self._normalize_extraction(data)
+        # Junk such as {"error": "..."} normalizes to all defaults - treat it as no extraction
+        return normalized if _has_extracted_values(normalized) else {}
+    
+    def _loads_json(self, text: str):
+        """Parse the model's JSON: bare, fenced, or embedded in commentary (None if hopeless)"""
+        try:
+            if text[:3] != "```":
+                return _json_loads(text)
+            # Strip the markdown fence with plain string ops
+            text = text.removeprefix("```json").removeprefix("```").removesuffix("```")
+            return _json_loads(text)
+        except ValueError:
+            pass
+        
+        # Second tier: the outermost {...} block, ignoring any text around it
+        match = _JSON_OBJECT.search(text)
+        if match:
+            try:
+                data = _json_loads(match.group())
+                print("Recovered JSON object from a malformed model response")
+                return data
+            except ValueError:
+                pass
+        print(f"Could not parse model response as JSON: {text[:100]}")
+        return None
+    
+    def _normalize_extraction(self, data: dict) -> dict:
+        """
+        Coerce parsed data to the prompt's shape: every section a dict holding exactly the
+        expected fields as strings, so BuyerInfo(**...) etc. never see missing or extra keys
+        """
+        normalized = {}
+        for section, fields in EXTRACTION_FIELDS.items():
+            values = data.get(section)
+            if not isinstance(values, dict):
+                values = {}
+            normalized[section] = {
+                field: default if values.get(field) is None else str(values[field])
+                for field, default in fields.items()
+            }
+        return normalized
+    
+    def _render_first_page(self, doc):
+        """Render the first page of an open fitz document to a PIL image (None if empty)"""
+        import fitz  # PyMuPDF
+        import PIL.Image
+        
+        if len(doc) == 0:
+            return None
+        page = doc[0]  # First page
+        # Render at higher resolution for better OCR (2x zoom), but cap the longest
+        # side so oversized scans don't inflate upload size and vision tokens
+        zoom = min(2.0, MAX_IMAGE_SIDE / max(page.rect.width, page.rect.height))
+        mat = fitz.Matrix(zoom, zoom)
+        # Grayscale is enough to read printed text and is a third of the RGB bytes
+        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+        
+        # Wrap the raw samples directly (no PNG encode/decode round-trip)
+        return PIL.Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    
+    def _get_doc_text(self, doc) -> str:
+        """Text of every page of an open fitz document"""
+        parts = []
+        for page in doc:
+            page_text = page.get_text("text")
+            if page_text:
+                parts.append(page_text)
+        return "".join(f"{part}\n" for part in parts)
     
     def _extract_pdf_text(self, pdf_path: str) -> str:
-        text = ""
+        """Extract text with PyMuPDF (much faster), falling back to pdfplumber"""
         try:
+            import fitz  # PyMuPDF
+            with _FITZ_LOCK, fitz.open(pdf_path) as doc:
+                return self._get_doc_text(doc)
+        except ImportError:
+            pass
+        except:
+            return ""
+        
+        parts = []
+        try:
+            import pdfplumber
             with pdfplumber.open(pdf_path) as pdf:
                 for page in pdf.pages:
                     page_text = page.extract_text()
                     if page_text:
-                        text += page_text + "\n"
+                        parts.append(page_text)
         except:
             pass
-        return text
+        return "".join(f"{part}\n" for part in parts)
 
 
-def process_bill_of_lading(bill_pdf_path: str, api_key: str, template_path: str, output_path: str = None):
-    """Process Bill of Lading and generate Certificate"""
+def process_bill_of_lading(bill_pdf_path: str, api_key: str, template_path: str, output_path: str = None,
+                           output_pdf: bool = True, extractor: GeminiExtractor = None):
+    """
+    Process Bill of Lading and generate Certificate (output_pdf=False skips the PDF conversion)
+    Pass an existing extractor to reuse its Gemini client across calls
+    """
     
-    extractor = GeminiExtractor(api_key)
+    if extractor is None:
+        extractor = GeminiExtractor(api_key)
     
     print(f"Extracting from: {bill_pdf_path}")
     data = extractor.extract_from_bill(bill_pdf_path)
@@ -602,55 +1394,108 @@ def process_bill_of_lading(bill_pdf_path: str, api_key: str, template_path: str,
     
     print(json.dumps(data, indent=2))
     
-    buyer = BuyerInfo(**data.get('buyer', {}))
-    seller = SellerInfo(**data.get('seller', {}))
-    product = ProductInfo(**data.get('product', {}))
-    shipping = ShippingInfo(**data.get('shipping', {}))
-    invoice = InvoiceInfo(**data.get('invoice', {}))
-    
     generator = WordCertificateGenerator(template_path)
-    serial_no, cert_no = generator.generate_certificate_number()
-    declaration_date = generator.generate_declaration_date(invoice.invoice_date)
-    
-    cert_data = CertificateData(
-        buyer=buyer,
-        seller=seller,
-        product=product,
-        shipping=shipping,
-        invoice=invoice,
-        serial_number=serial_no,
-        certificate_number=cert_no,
-        declaration_date=declaration_date
-    )
+    cert_data = generator.build_certificate_data(data)
     
     if not output_path:
         output_path = f"certificate_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
     
-    return generator.create_certificate(cert_data, output_path)
+    return generator.create_certificate(cert_data, output_path, output_pdf=output_pdf)
+
+
+def process_bills_batch(bill_pdf_paths: List[str], api_key: str, template_path: str,
+                        output_dir: str = ".", workers: int = None, output_pdf: bool = True) -> list:
+    """
+    Process many Bills of Lading in parallel, one worker process per bill
+    Word documents are generated by the workers, then converted to PDF in a single
+    LibreOffice run (startup cost dominates per-document conversion)
+    
+    Returns a list of (docx_path, pdf_path) tuples in input order; a bill that
+    fails yields the exception instead so one bad document does not abort the batch
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    
+    os.makedirs(output_dir, exist_ok=True)
+    # Timestamped like process_bill_of_lading's default name, so reruns do not overwrite earlier certificates
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                process_bill_of_lading, bill_pdf_path, api_key, template_path,
+                os.path.join(output_dir, f"certificate_{stamp}_{i + 1}.docx"), False
+            )
+            for i, bill_pdf_path in enumerate(bill_pdf_paths)
+        ]
+        
+        results = []
+        for bill_pdf_path, future in zip(bill_pdf_paths, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Failed to process {bill_pdf_path}: {e}")
+                results.append(e)
+    
+    if output_pdf:
+        docx_paths = [result[0] for result in results if isinstance(result, tuple)]
+        pdf_paths = iter(WordCertificateGenerator(template_path).convert_to_pdf_batch(docx_paths))
+        results = [(result[0], next(pdf_paths)) if isinstance(result, tuple) else result
+                   for result in results]
+    
+    return results
 
 
 def main():
     import argparse
+    import glob
     
     parser = argparse.ArgumentParser(description='Generate Certificate of Origin')
-    parser.add_argument('bill_pdf', help='Bill of Lading PDF')
+    parser.add_argument('bill_pdf', nargs='*', help='Bill of Lading PDF(s)')
+    parser.add_argument('--directory', '-d', help='Process every PDF in this directory')
+    parser.add_argument('--workers', '-w', type=int, help='Worker processes for multiple bills (default: CPU count)')
     parser.add_argument('--api-key', required=True, help='Gemini API key')
     parser.add_argument('--template', '-t', required=True, help='Word template (.docx)')
-    parser.add_argument('--output', '-o', help='Output path')
+    parser.add_argument('--output', '-o', help='Output path (output directory with --directory or several bills)')
     parser.add_argument('--no-pdf', action='store_true', help='Skip PDF generation')
     
     args = parser.parse_args()
     
-    docx_path, pdf_path = process_bill_of_lading(
-        args.bill_pdf,
+    bill_pdfs = list(args.bill_pdf)
+    if args.directory:
+        bill_pdfs += sorted(glob.glob(os.path.join(args.directory, '*.pdf')))
+    if not bill_pdfs:
+        parser.error('give at least one Bill of Lading PDF or --directory')
+    
+    # A lone positional bill keeps --output as a file path; --directory always means batch mode
+    if len(bill_pdfs) == 1 and not args.directory:
+        docx_path, pdf_path = process_bill_of_lading(
+            bill_pdfs[0],
+            args.api_key,
+            args.template,
+            args.output,
+            output_pdf=not args.no_pdf
+        )
+        
+        print(f"\nGenerated: {docx_path}")
+        if pdf_path:
+            print(f"Generated: {pdf_path}")
+        return
+    
+    results = process_bills_batch(
+        bill_pdfs,
         args.api_key,
         args.template,
-        args.output
+        output_dir=args.output or '.',
+        workers=args.workers,
+        output_pdf=not args.no_pdf
     )
     
-    print(f"\nGenerated: {docx_path}")
-    if pdf_path:
-        print(f"Generated: {pdf_path}")
+    print()
+    for bill_pdf, result in zip(bill_pdfs, results):
+        if isinstance(result, tuple):
+            docx_path, pdf_path = result
+            print(f"{bill_pdf}: generated {docx_path}" + (f" and {pdf_path}" if pdf_path else ""))
+        else:
+            print(f"{bill_pdf}: FAILED - {result}")
 
 
 if __name__ == "__main__":